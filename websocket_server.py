@@ -1,129 +1,418 @@
 import asyncio
-import json
 import logging
-from typing import Dict, List
-from datetime import datetime
+import os
+import socket
+from contextlib import asynccontextmanager
+from typing import Any, Dict, List, Optional, Set
+from dataclasses import dataclass
+from types import MappingProxyType
+import msgspec
 # 導入 FastAPI 和相關模組
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from starlette.websockets import WebSocketState
 from starlette.middleware.cors import CORSMiddleware # 新增：為了部署到 Render
 
-# 配置日誌記錄，包含時間戳和等級
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# 配置日誌記錄，包含時間戳和等級；正式環境預設 WARNING，可用 LOG_LEVEL 環境變數調整
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "WARNING").upper(), format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# 逐則訊息的除錯日誌只在 DEBUG 等級開啟時才產生，避免熱路徑上的格式化成本
+_LOG_P2P = logger.isEnabledFor(logging.DEBUG)
+
+# JSON 與 MessagePack 的編解碼器都只建立一次並重複使用；
+# 取出綁定方法作為模組層級別名，避免熱路徑上重複查找屬性
+_dumps_into = msgspec.json.Encoder().encode_into
+_loads = msgspec.json.Decoder().decode
+_pack = msgspec.msgpack.Encoder().encode
+_unpack = msgspec.msgpack.Decoder().decode
+
+MSGPACK_SUBPROTOCOL = "msgpack" # 客戶端以此子協定表明要改用 MessagePack 二進位 frame
+JSON_SUBPROTOCOL = "json"       # 明確要求 JSON 文字 frame；未提供任何子協定時也預設為 JSON
+# 加上 ".batch" 的版本表示客戶端會處理 {"type": "batch", "items": [...]} 合併訊息；
+# 其餘客戶端一律逐則收到原始訊息
+MSGPACK_BATCH_SUBPROTOCOL = "msgpack.batch"
+JSON_BATCH_SUBPROTOCOL = "json.batch"
+
+# 子協定 -> (是否使用 MessagePack, 是否接受 batch)；依此順序挑選客戶端提供的第一個
+_SUBPROTOCOLS = {
+    MSGPACK_BATCH_SUBPROTOCOL: (True, True),
+    MSGPACK_SUBPROTOCOL: (True, False),
+    JSON_BATCH_SUBPROTOCOL: (False, True),
+    JSON_SUBPROTOCOL: (False, False),
+}
+
+SEND_TIMEOUT = 5.0   # 單一客戶端傳送逾時（秒），超過即視為斷線
+# 每個連線的待送佇列上限。佇列滿只代表發送方送得比轉送快，不代表接收方失效：
+# 點對點訊息會讓發送方等待，廣播則對該連線略過此則；接收方只在自己的傳送逾時時才斷開
+OUTBOX_SIZE = int(os.environ.get("OUTBOX_SIZE", "256"))
+BATCH_WINDOW = 0.003 # 合併廣播的收集時間窗（秒）
+MAX_CONNS = 2000     # 同時連線上限，超過時以 1013 (Try Again Later) 拒絕
+# 協定層心跳 (WebSocket ping/pong 控制 frame)：瀏覽器會自動回覆 pong，客戶端不需任何程式碼；
+# 逾時未回覆的連線由 uvicorn 關閉，接收迴圈隨之收到斷線事件
+PING_INTERVAL = 20.0 # 送出 ping 的間隔（秒）
+PING_TIMEOUT = 20.0  # 等待 pong 的時限（秒）
+
+# ----------------------------------------------
+# 0. 訊息格式 (Frame)
+# ----------------------------------------------
+
+class Frame:
+    """一則待送訊息，同時代表 JSON 文字與 MessagePack 兩種線上格式。
+
+    兩種格式都按需產生且只產生一次；轉送時保留原始 frame，
+    只有對方使用另一種格式時才轉碼。
+    """
+    __slots__ = ("_text", "_packed")
+
+    def __init__(self, *, text: Optional[str] = None, packed: Optional[bytes] = None):
+        self._text = text
+        self._packed = packed
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self._render_text()
+        return self._text
+
+    @property
+    def packed(self) -> bytes:
+        if self._packed is None:
+            self._packed = self._render_packed()
+        return self._packed
+
+    def _render_text(self) -> str:
+        return _json_text(_unpack(self._packed))
+
+    def _render_packed(self) -> bytes:
+        return _pack(_loads(self._text))
+
+
+class SignalHeader(msgspec.Struct, frozen=True, gc=False):
+    """訊息路由所需的標頭欄位；SDP、candidate 等其餘欄位不解析，原樣轉送。
+
+    欄位只有字串，設為 gc=False 讓每則訊息產生的物件不被 GC 追蹤；
+    frozen 確保各處理函式不會改動共用的標頭。
+    """
+    type: Optional[str] = None
+    senderId: Optional[str] = None
+    targetId: Optional[str] = None
+
+
+# 產生文字 frame 用的暫存區：JSON 直接編碼進同一個 bytearray 再解碼成 str，
+# 省下每次的中間 bytes 物件。渲染全程同步，不會有兩個呼叫交錯使用
+_scratch = bytearray()
+_SCRATCH_KEEP = 256 * 1024 # 超過此大小的暫存區用完即釋放，避免一則大訊息長期佔用記憶體
+
+
+def _json_text(obj: Any, prefix: bytes = b"", suffix: bytes = b"") -> str:
+    """把 obj 編碼成 JSON 並前後接上已序列化的片段，直接返回 str。"""
+    buf = _scratch
+    buf[:] = prefix
+    _dumps_into(obj, buf, len(prefix))
+    buf += suffix
+    text = buf.decode()
+    if len(buf) > _SCRATCH_KEEP:
+        buf.clear()
+    return text
+
+
+# 只解析 SignalHeader 宣告的欄位，其餘內容在 C 層直接略過
+_decode_json_header = msgspec.json.Decoder(SignalHeader).decode
+_decode_packed_header = msgspec.msgpack.Decoder(SignalHeader).decode
+
+
+# online_users_list 的外層結構固定，預先序列化，只需填入用戶列表
+_ONLINE_USERS_PREFIX = b'{"type":"online_users_list","users":'
+_ONLINE_USERS_SUFFIX = b',"senderId":"server"}'
+
+# user_joined 同理，只有 newUserId 每次不同
+_USER_JOINED_PREFIX = b'{"type":"user_joined","senderId":"server","targetId":"all","newUserId":'
+_USER_JOINED_SUFFIX = b'}'
+
+class BatchFrame(Frame):
+    """把多則訊息包成 {"type": "batch", "items": [...]}，各項目直接沿用已編碼的內容。"""
+    __slots__ = ("_items",)
+
+    def __init__(self, items: List[Frame]):
+        super().__init__()
+        self._items = items
+
+    def _render_text(self) -> str:
+        return '{"type":"batch","items":[' + ",".join(self._item_payloads(binary=False)) + "]}"
+
+    def _render_packed(self) -> bytes:
+        items = [msgspec.Raw(packed) for packed in self._item_payloads(binary=True)]
+        return _pack({"type": "batch", "items": items})
+
+    def _item_payloads(self, binary: bool):
+        """逐項取出已編碼內容；個別項目無法轉成此格式時只略過該項，其餘照常送出。"""
+        for item in self._items:
+            try:
+                yield item.packed if binary else item.text
+            except Exception as e:
+                logger.warning("批次項目轉碼失敗，略過: %r", e)
+
+
 # ----------------------------------------------
 # 1. 連線管理類別 (Connection Manager)
 # ----------------------------------------------
 
+@dataclass(slots=True, eq=False)
+class Conn:
+    """單一連線的所有狀態；以同一個物件串起 WebSocket、用戶 ID 與待送佇列。"""
+    ws: WebSocket
+    queue: asyncio.Queue
+    binary: bool = False               # 是否已協商使用 MessagePack
+    batch: bool = False                # 是否已協商接受 batch 合併訊息
+    user_id: Optional[str] = None
+    relay: Optional[asyncio.Task] = None
+
+
 class ConnectionManager:
-    """以單例模式管理所有活動連線及其共享數據。"""
+    """以單例模式管理所有活動連線。
+
+    每個連線都有自己的待送佇列與傳送任務 (relay)，廣播只需把訊息放進佇列，
+    不會等待任何客戶端的網路傳輸，慢速客戶端也不會拖慢其他人。
+    """
     
     def __init__(self):
-        self.active_connections: set[WebSocket] = set()
-        self.user_to_ws: Dict[str, WebSocket] = {} # Map<ID, WebSocket>
-        self.ws_to_user: Dict[WebSocket, str] = {} # Map<WebSocket, ID> - 反向查找
-
-        self.main_json_data = {
-            "status": "Offline",
-            "users_online": 0,
-            "last_updated": datetime.now().isoformat(),
-            "custom_data": {}
-        }
+        # 唯一的連線來源：dict 保留插入順序，刪除仍是 O(1)，廣播時迭代其 tuple 快照
+        self.conns: Dict[WebSocket, Conn] = {} # Map<WebSocket, Conn>
+        self.by_user: Dict[str, Conn] = {} # Map<ID, Conn> - 僅含已註冊的連線
+        self._pending: List[Frame] = [] # 等待合併廣播的訊息
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._batch_conns = 0 # 協商了 batch 的連線數；為 0 時不需暫存廣播
+        self._users_frame: Optional[Frame] = None # online_users_list 快取，用戶名單變動時清除
+        # 背景任務（關閉連線、等待佇列空位）的強參照：事件迴圈只保留弱參照，未保存的任務可能在完成前被回收
+        self._tasks: Set[asyncio.Task] = set()
         
-    async def connect(self, websocket: WebSocket):
-        """處理新連線，並更新用戶數。"""
-        await websocket.accept()
-        self.active_connections.add(websocket)
-        self.update_user_count()
+    async def connect(self, websocket: WebSocket) -> Optional[Conn]:
+        """處理新連線，協商訊息格式、建立其待送佇列與傳送任務。
+
+        已達連線上限時拒絕連線並回傳 None。
+        """
+        if len(self.conns) >= MAX_CONNS:
+            logger.warning("連線數已達上限 %d，拒絕新連線。", MAX_CONNS)
+            await websocket.close(code=1013)
+            return None
+        offered = websocket.scope.get("subprotocols", ())
+        subprotocol = next((name for name in _SUBPROTOCOLS if name in offered), None)
+        # 未要求任何已知子協定的舊版客戶端維持 JSON 文字 frame，也不會收到 batch
+        binary, batch = _SUBPROTOCOLS.get(subprotocol, (False, False))
+        await websocket.accept(subprotocol=subprotocol)
+        conn = Conn(websocket, asyncio.Queue(maxsize=OUTBOX_SIZE), binary, batch)
+        if batch:
+            self._batch_conns += 1
+        conn.relay = asyncio.create_task(self._relay(conn))
+        self.conns[websocket] = conn
+        return conn
 
     def register_user(self, user_id: str, websocket: WebSocket):
         """將連線與其唯一的客戶端 ID 關聯。"""
+        conn = self.conns.get(websocket)
+        if conn is None:
+            return
         # 確保只在 ID 不存在時註冊，防止覆蓋
-        if user_id not in self.user_to_ws:
-            self.user_to_ws[user_id] = websocket
-            self.ws_to_user[websocket] = user_id
-            logger.info(f"用戶 ID '{user_id}' 已註冊。")
+        if user_id not in self.by_user:
+            # 同一連線改用新 ID 時，移除舊 ID 的對應，避免殘留
+            if conn.user_id is not None:
+                self.by_user.pop(conn.user_id, None)
+            conn.user_id = user_id
+            self.by_user[user_id] = conn
+            self._users_frame = None
+            logger.info("用戶 ID '%s' 已註冊。", user_id)
 
             # 🔥 關鍵：如果確實是新用戶，廣播通知所有其他人
-            asyncio.create_task(self.broadcast_user_joined(user_id))
+            self.broadcast_user_joined(user_id)
         else:
-            logger.warning(f"用戶 ID '{user_id}' 已存在，跳過註冊。")
+            logger.warning("用戶 ID '%s' 已存在，跳過註冊。", user_id)
 
-    async def broadcast_user_joined(self, new_user_id: str):
+    def broadcast_user_joined(self, new_user_id: str):
         """通知所有在線用戶有新 ID 上線。"""
-        message = {
-            "type": "user_joined", # 新的信令類型
-            "senderId": "server",
-            "targetId": "all",
-            "newUserId": new_user_id
-        }
-        json_message = json.dumps(message)
+        # 外層結構預先序列化，只編碼新用戶 ID；MessagePack 客戶端需要時才由文字轉碼
+        frame = Frame(text=_json_text(new_user_id, _USER_JOINED_PREFIX, _USER_JOINED_SUFFIX))
         
         # 廣播給所有已經註冊的用戶（除了新加入的用戶自己）
-        for user_id, ws in self.user_to_ws.items():
-            if user_id != new_user_id:
-                try:
-                    await ws.send_text(json_message)
-                except Exception as e:
-                    logger.error(f"通知 {user_id} 新用戶上線失敗: {e}")
+        targets = [conn for user_id, conn in self.by_user.items() if user_id != new_user_id]
+        for conn in targets:
+            self._enqueue(conn, frame)
 
     def disconnect(self, websocket: WebSocket):
-        """處理斷線，並更新用戶數。"""
-        self.active_connections.discard(websocket)
-        
-        user_id = self.ws_to_user.pop(websocket, None)
-        if user_id:
-            self.user_to_ws.pop(user_id, None)
-            logger.info(f"用戶 ID '{user_id}' 已移除。")
-        
-        self.update_user_count()
+        """處理斷線，並停止其傳送任務。"""
+        conn = self.conns.pop(websocket, None)
+        if conn is None:
+            return
+        if conn.batch:
+            self._batch_conns -= 1
 
-    def update_user_count(self):
-        """更新共享數據中的線上用戶數。"""
-        self.main_json_data["users_online"] = len(self.active_connections)
+        # 傳送任務本身呼叫 disconnect 時不取消自己，讓它自然結束
+        if conn.relay is not None and conn.relay is not asyncio.current_task():
+            conn.relay.cancel()
+        
+        if conn.user_id and self.by_user.get(conn.user_id) is conn:
+            del self.by_user[conn.user_id]
+            self._users_frame = None
+            logger.info("用戶 ID '%s' 已移除。", conn.user_id)
 
     def get_online_users(self) -> List[str]:
         """返回所有在線用戶的 ID 列表。"""
-        return list(self.user_to_ws.keys())
+        return list(self.by_user.keys())
+
+    def online_users_frame(self) -> Frame:
+        """返回 online_users_list 訊息；名單未變動前重複請求都共用同一個已編碼的 Frame。"""
+        if self._users_frame is None:
+            text = _json_text(self.get_online_users(), _ONLINE_USERS_PREFIX, _ONLINE_USERS_SUFFIX)
+            self._users_frame = Frame(text=text)
+        return self._users_frame
 
     # 新增：點對點傳輸方法
-    async def send_personal_message(self, message: str, user_id: str) -> bool:
-        """將訊息傳送給特定的客戶端 ID。"""
-        client = self.user_to_ws.get(user_id)
-        # 檢查是否連線，且狀態為連接中
-        if client and client.client_state == WebSocketState.CONNECTED:
-            try:
-                await client.send_text(message)
-                return True
-            except Exception as e:
-                logger.error(f"傳送訊息給 {user_id} 時發生錯誤: {e}")
-                # 如果傳輸失敗，視為斷線處理
-                self.disconnect(client) 
-                return False
-        
-        logger.warning(f"用戶 ID '{user_id}' 不在線或未註冊。無法傳送訊息。")
-        return False
+    async def send_personal_message(self, frame: Frame, user_id: str) -> bool:
+        """將訊息放入特定客戶端 ID 的待送佇列。
 
-    async def broadcast(self, message: str):
-        """將訊息廣播給所有已連線的客戶端，並安全地處理斷線錯誤。"""
-        clients_to_remove = set() 
-        
-        for client in self.active_connections:
-            if client.client_state == WebSocketState.CONNECTED:
+        佇列已滿時讓發送方等待（背壓），而不是斷開接收方：P2P 訊息是在發送方的
+        接收迴圈中轉送的，發送方連發時佇列會暫時塞滿，但接收方本身可能完全正常。
+        等待逾時仍放不進去時只丟棄這則訊息；接收方真的失效會由其傳送任務的逾時處理。
+        """
+        conn = self.by_user.get(user_id)
+        if conn is None:
+            logger.warning("用戶 ID '%s' 不在線或未註冊。無法傳送訊息。", user_id)
+            return False
+        self._flush_before(conn)
+        try:
+            conn.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            pass
+        try:
+            await asyncio.wait_for(conn.queue.put(frame), SEND_TIMEOUT)
+            return True
+        except asyncio.TimeoutError:
+            logger.warning("用戶 ID '%s' 的待送佇列持續已滿，丟棄一則訊息。", user_id)
+            return False
+
+    def reply(self, conn: Conn, frame: Frame) -> bool:
+        """直接回覆發出請求的連線，不需經過用戶 ID 查找。"""
+        return self._enqueue(conn, frame)
+
+    def _enqueue(self, conn: Conn, frame: Frame) -> bool:
+        """把訊息放進連線的待送佇列；佇列已滿時丟棄此則並記錄，不斷開連線。"""
+        self._flush_before(conn)
+        try:
+            conn.queue.put_nowait(frame)
+            return True
+        except asyncio.QueueFull:
+            logger.warning("客戶端待送佇列已滿，丟棄一則訊息。")
+            return False
+
+    async def _put_waiting(self, conns: List[Conn], frame: Frame):
+        """對佇列已滿的連線等待空位（背壓），最多 SEND_TIMEOUT 秒，各連線併發等待。
+
+        佇列滿只代表發送方送得比轉送快；接收方正常時空位很快就會出現，訊息不會遺失。
+        逾時仍放不進去才丟棄；接收方真的失效會由其傳送任務的逾時處理。
+        """
+        results = await asyncio.gather(
+            *(asyncio.wait_for(conn.queue.put(frame), SEND_TIMEOUT) for conn in conns),
+            return_exceptions=True,
+        )
+        dropped = sum(isinstance(result, asyncio.TimeoutError) for result in results)
+        if dropped:
+            logger.warning("%d 個客戶端的待送佇列持續已滿，略過此則廣播。", dropped)
+
+    def _flush_before(self, conn: Conn):
+        """batch 連線還有暫存中的廣播時先送出，避免之後的訊息搶在先前的廣播之前。"""
+        if conn.batch and self._pending:
+            self._flush()
+
+    async def _relay(self, conn: Conn):
+        """依序取出待送佇列中的訊息，以該連線協商的格式送出；傳送失敗或逾時即視為斷線。"""
+        # 迴圈外先取出區域變數，避免每則訊息重複查找屬性與判斷格式
+        binary = conn.binary
+        get = conn.queue.get
+        send = conn.ws.send_bytes if binary else conn.ws.send_text
+        wait_for = asyncio.wait_for
+        try:
+            while True:
+                frame = await get()
                 try:
-                    await client.send_text(message) 
+                    payload = frame.packed if binary else frame.text
                 except Exception as e:
-                    logger.error(f"廣播時發生錯誤: {e}")
-                    clients_to_remove.add(client)
-            else:
-                 clients_to_remove.add(client)
+                    # 無法轉成此連線格式的訊息只略過，不影響連線本身
+                    logger.warning("訊息轉碼失敗，略過: %r", e)
+                    continue
+                await wait_for(send(payload), SEND_TIMEOUT)
+        except Exception as e:
+            # 取消 (CancelledError) 不是 Exception 的子類別，會直接往外傳遞
+            logger.error("傳送訊息時發生錯誤: %r", e)
+            self._mark_dead(conn)
 
-        for client in clients_to_remove:
-            self.disconnect(client) # 使用 disconnect 函數來處理所有清理工作
-        
-        if clients_to_remove:
-            logger.info(f"已移除 {len(clients_to_remove)} 個斷線客戶端。當前連線數: {len(self.active_connections)}")
+    def _mark_dead(self, conn: Conn, code: int = 1013):
+        """移除傳送失敗或逾時的連線，並在背景關閉底層 socket，讓接收迴圈隨之結束。"""
+        self.disconnect(conn.ws)
+        self._spawn(self._close_quietly(conn.ws, code))
+
+    def _spawn(self, coro):
+        """建立背景任務並保留參照直到完成。"""
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _close_quietly(self, websocket: WebSocket, code: int = 1013):
+        """嘗試關閉連線；連線可能早已斷開，此時 close 會拋出例外，直接忽略即可。"""
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def broadcast(self, frame: Frame):
+        """將訊息廣播給所有已連線的客戶端。
+
+        未協商 batch 的連線立即收到這則訊息，不受合併時間窗延遲，順序也與發送方一致；
+        協商了 batch 的連線則在 BATCH_WINDOW 後收到合併後的 frame。
+        所有佇列共用同一個 Frame，每種線上格式最多只編碼一次。
+        佇列已滿時與點對點訊息相同，讓發送方等待空位，而不是丟棄或斷開接收方。
+        """
+        full: List[Conn] = []
+        queue_full = asyncio.QueueFull
+
+        for conn in self.conns.values():
+            if conn.batch:
+                continue
+            try:
+                conn.queue.put_nowait(frame)
+            except queue_full:
+                full.append(conn)
+
+        if self._batch_conns:
+            self._pending.append(frame)
+            if self._flush_handle is None:
+                self._flush_handle = asyncio.get_running_loop().call_later(BATCH_WINDOW, self._flush)
+
+        if full:
+            await self._put_waiting(full, frame)
+
+    def _flush(self):
+        """把時間窗內累積的訊息送給協商了 batch 的連線。
+
+        只有一則時原樣送出；多則時包成 {"type": "batch", "items": [...]}，
+        各項目沿用已編碼的內容，不重新序列化。由計時器呼叫，無法等待，
+        佇列已滿的連線改由背景任務等待空位。
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        frame = pending[0] if len(pending) == 1 else BatchFrame(pending)
+        full: List[Conn] = []
+        for conn in self.conns.values():
+            if not conn.batch:
+                continue
+            try:
+                conn.queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                full.append(conn)
+        if full:
+            self._spawn(self._put_waiting(full, frame))
 
 manager = ConnectionManager()
 
@@ -131,13 +420,29 @@ manager = ConnectionManager()
 # ----------------------------------------------
 # 2. FastAPI 應用程式實例
 # ----------------------------------------------
-app = FastAPI() 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """應用程式啟動時記錄執行環境；心跳由 WebSocket 協定層的 ping/pong 負責。"""
+    # loop="auto" 找不到 uvloop 時會默默退回標準 asyncio；這種情況以 WARNING 記錄，
+    # 在預設日誌等級下也看得到
+    loop_module = type(asyncio.get_running_loop()).__module__
+    if loop_module.startswith("uvloop"):
+        logger.info("事件迴圈實作: %s", loop_module)
+    else:
+        logger.warning("未使用 uvloop，事件迴圈實作: %s", loop_module)
+    yield
+
+app = FastAPI(lifespan=lifespan) 
 
-# ⚠️ 部署所需的 CORS 配置
+# ⚠️ 部署所需的 CORS 配置：以 ALLOWED_ORIGINS 環境變數（逗號分隔）指定允許的來源，
+# 載入時計算一次。規範不允許萬用字元 "*" 搭配 credentials，因此只有明確列出來源時才開啟。
+ALLOWED_ORIGINS = frozenset(
+    origin.strip() for origin in os.environ.get("ALLOWED_ORIGINS", "*").split(",") if origin.strip()
+)
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
+    allow_origins=list(ALLOWED_ORIGINS),
+    allow_credentials="*" not in ALLOWED_ORIGINS,
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -146,97 +451,194 @@ app.add_middleware(
 # 3. WebSocket 路由 - 修正版
 # ----------------------------------------------
 
+# 各訊息類型的處理函式，簽名一致：(連線, 已解析的標頭, 原始 frame)；
+# 點對點轉送在目標佇列已滿時需要等待，因此處理函式一律為 async
+
+async def _handle_register(conn: Conn, header: SignalHeader, frame: Frame):
+    """處理客戶端註冊訊息。"""
+    sender_id = header.senderId
+    if sender_id and sender_id not in manager.by_user:
+        manager.register_user(sender_id, conn.ws)
+        logger.info("✅ 成功處理客戶端註冊：%s", sender_id)
+    else:
+        logger.warning("客戶端註冊訊息重複或無效：%s", sender_id)
+
+
+async def _handle_p2p(conn: Conn, header: SignalHeader, frame: Frame):
+    """處理 WebRTC 信令與 P2P 訊息：原樣轉發給 targetId。"""
+    message_type = header.type
+    if conn.user_id is None:
+        logger.warning("[P2P 信令] 收到 %s 但發送方 ID 未註冊，跳過。", message_type)
+        return
+
+    target_id = header.targetId
+    if target_id:
+        # 點對點轉發給目標用戶
+        success = await manager.send_personal_message(frame, target_id)
+        if _LOG_P2P:
+            logger.debug("[P2P 信令] %s -> %s: %s. %s.", header.senderId, target_id, message_type, "成功轉發" if success else "轉發失敗")
+    else:
+        logger.warning("[P2P 信令] 收到信令但缺少 targetId: %s", message_type)
+
+
+async def _handle_broadcast(conn: Conn, header: SignalHeader, frame: Frame):
+    """處理遊戲廣播訊息：標頭解析已確認內容是合法物件，直接廣播原始 frame。"""
+    if _LOG_P2P:
+        logger.debug("廣播訊息類型: %s", header.type)
+    await manager.broadcast(frame)
+
+
+async def _handle_online_users(conn: Conn, header: SignalHeader, frame: Frame):
+    """處理請求在線用戶列表，直接回覆給發出請求的連線。"""
+    manager.reply(conn, manager.online_users_frame())
+    logger.debug("📢 已將 %d 個用戶 ID 列表回傳給 %s", len(manager.by_user), conn.user_id or header.senderId)
+
+
+# 訊息類型 -> 處理函式；模組載入時建好的唯讀查找表，每則訊息只需一次 dict 查找
+HANDLERS = MappingProxyType({
+    "client_register": _handle_register,
+    "offer": _handle_p2p,
+    "answer": _handle_p2p,
+    "candidate": _handle_p2p,
+    "chat_message": _handle_p2p,
+    "Sync_Boss_Data": _handle_broadcast,
+    "Boss_Death": _handle_broadcast,
+    "Ack_Sync": _handle_broadcast,
+    "request_online_users": _handle_online_users,
+})
+
+
 @app.websocket("/ws") # 路由路徑
 async def fastapi_websocket_endpoint(websocket: WebSocket):
-    
-    current_user_id = None 
 
     try:
-        # 1. 註冊連線
-        await manager.connect(websocket)
-        logger.info(f"新客戶端連線。當前連線數: {len(manager.active_connections)}")
-        
+        # 1. 註冊連線（已達上限時 connect 會直接拒絕）
+        conn = await manager.connect(websocket)
+        if conn is None:
+            return
+        logger.debug("新客戶端連線。當前連線數: %d", len(manager.conns))
+        # 格式錯誤或類型未知的訊息每條連線只記錄一次，避免故障或惡意客戶端灌爆日誌
+        invalid_logged = False
+
         # 2. 處理接收到的訊息
         while True:
-            # 接收客戶端訊息
-            message = await websocket.receive_text()
-            
+            # 接收客戶端訊息：文字 frame 為 JSON，二進位 frame 為 MessagePack
+            event = await websocket.receive()
+            if event["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(event.get("code", 1000))
+
+            # 只解析路由用的標頭，原始 frame 保留下來供轉送
+            text = event.get("text")
             try:
-                data = json.loads(message)
-            except json.JSONDecodeError:
-                logger.warning(f"接收到非 JSON 訊息，忽略。")
-                continue
-            
-            message_type = data.get("type")
-            sender_id = data.get("senderId")
-            target_id = data.get("targetId") # 提前取得
-
-            
-            # --- 【步驟 A：檢查並設置 current_user_id】 ---
-            # 確保連線的 current_user_id 與其 senderId 匹配
-            if sender_id and sender_id in manager.user_to_ws:
-                current_user_id = sender_id
-            
-            # --- 【步驟 B：處理信令或指令】 ---
-
-            if message_type == 'client_register':
-                # 處理客戶端註冊訊息
-                if sender_id and sender_id not in manager.user_to_ws:
-                    manager.register_user(sender_id, websocket)
-                    current_user_id = sender_id
-                    logger.info(f"✅ 成功處理客戶端註冊：{sender_id}")
-                else:
-                    logger.warning(f"客戶端註冊訊息重複或無效：{sender_id}")
-            
-            elif message_type in ['offer','answer','candidate','chat_message']:
-                # 處理 WebRTC 信令與 P2P 訊息
-                if not current_user_id:
-                    logger.warning(f"[P2P 信令] 收到 {message_type} 但發送方 ID 未註冊，跳過。")
-                    continue
-                    
-                if target_id:
-                    # 點對點轉發給目標用戶
-                    success = await manager.send_personal_message(message, target_id)
-                    log_action = "成功轉發" if success else "轉發失敗"
-                    logger.info(f"[P2P 信令] {sender_id} -> {target_id}: {message_type}. {log_action}.")
-                else:
-                    logger.warning(f"[P2P 信令] 收到信令但缺少 targetId: {message_type}")
-
-            elif message_type in ["Sync_Boss_Data", "Boss_Death", "Ack_Sync"]:
-                # 處理遊戲廣播訊息
-                json_string_to_broadcast = json.dumps(data)
-                
-                logger.info(f"廣播訊息類型: {message_type}")
-                await manager.broadcast(json_string_to_broadcast)
-                
-            elif message_type == 'request_online_users':
-                # 處理請求在線用戶列表
-                online_users = manager.get_online_users()
-                
-                response = {
-                    "type": "online_users_list",
-                    "users": online_users,
-                    "senderId": "server"
-                }
-                
-                target_id_for_response = current_user_id if current_user_id else sender_id
-                if target_id_for_response:
-                    await manager.send_personal_message(json.dumps(response), target_id_for_response)
-                    logger.info(f"📢 已將 {len(online_users)} 個用戶 ID 列表回傳給 {target_id_for_response}")
+                if text is not None:
+                    header = _decode_json_header(text)
+                    frame = Frame(text=text)
                 else:
-                    logger.error("🚫 無法回覆在線用戶列表：目標 ID 不明。")
-                
-            else:
-                logger.warning(f"收到未知訊息類型: {message_type}") # 將 INFO 改為 WARNING
+                    raw = event.get("bytes") or b""
+                    header = _decode_packed_header(raw)
+                    frame = Frame(packed=raw)
+            except msgspec.DecodeError as e:
+                # ValidationError 是 DecodeError 的子類別：標頭欄位型別不符也在解碼當下被拒絕
+                if not invalid_logged:
+                    logger.warning("接收到無法解析的訊息，忽略（此連線之後不再記錄）: %s", e)
+                    invalid_logged = True
+                continue
+
+            # 依訊息類型分派處理
+            handler = HANDLERS.get(header.type)
+            if handler is not None:
+                await handler(conn, header, frame)
+            elif not invalid_logged:
+                logger.warning("收到未知訊息類型，忽略（此連線之後不再記錄）: %s", header.type)
+                invalid_logged = True
+
+            # 讓出事件迴圈：同一客戶端連續送來的訊息可能不經等待就被讀出，
+            # 每則之後讓各傳送任務有機會清空佇列，減少觸發背壓或丟棄的機會
+            await asyncio.sleep(0)
 
 
     except WebSocketDisconnect:
         logger.info("客戶端關閉連線。")
-        # 斷線時，清理 active_connections 和 user/ws maps
+        # 斷線時，清理 conns 與 by_user
     except Exception as e:
-        logger.error(f"連線錯誤：{e}")
+        logger.error("連線錯誤：%s", e)
         # 發生其他錯誤時
     finally:
-        # 3. 移除連線 (這裡會處理 active_connections, user_to_ws, ws_to_user 的移除)
+        # 3. 移除連線 (這裡會處理 conns 與 by_user 的移除，並停止傳送任務)
         manager.disconnect(websocket)
-        logger.info(f"客戶端已斷開。當前連線數: {len(manager.active_connections)}")
\ No newline at end of file
+        logger.info("客戶端已斷開。當前連線數: %d", len(manager.conns))
+
+
+# ----------------------------------------------
+# 4. 啟動設定 (直接執行或經 gunicorn)
+# ----------------------------------------------
+# 以下設定（WS_DEFLATE、Sans-IO 協定實作、協定層心跳、TCP 選項）由兩種啟動方式共用：
+#   python websocket_server.py
+#   gunicorn -k websocket_server.Worker websocket_server:app
+# 使用 gunicorn 預設的 UvicornWorker 時這些設定都不會生效。
+
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024 # 收發緩衝區大小；實際上限受 net.core.wmem_max / rmem_max 限制
+
+UVICORN_CONFIG = {
+    # loop="auto" 在已安裝 uvloop 時會優先採用，未安裝的平台（例如 Windows）則退回標準 asyncio 事件迴圈
+    "loop": "auto",
+    "http": "httptools",
+    # websockets 的 Sans-IO 實作：每個 frame 經過的 Python 層較少，
+    # 且 permessage-deflate 採用較小的壓縮視窗 (12 bits, memLevel 5)，每條連線的壓縮狀態佔用大幅下降
+    "ws": "websockets-sansio",
+    # 重複度高的 JSON（例如 Sync_Boss_Data）經 permessage-deflate 壓縮後可大幅減少傳輸量；
+    # 壓縮狀態每條連線各自一份，連線數大、記憶體吃緊時可設 WS_DEFLATE=0 關閉
+    "ws_per_message_deflate": os.environ.get("WS_DEFLATE", "1") != "0",
+    # 此實作自 uvicorn 0.44 起才會送出協定層 ping；更舊的版本沒有心跳，失聯的連線永遠不會被移除
+    "ws_ping_interval": PING_INTERVAL,
+    "ws_ping_timeout": PING_TIMEOUT,
+}
+
+
+def _tune_socket(sock: socket.socket):
+    """設定監聽 socket 的 TCP 選項。
+
+    Linux 上 accept 出來的連線會繼承 TCP_NODELAY 與收發緩衝區設定，
+    小型信令（例如 ICE candidate）不會被 Nagle 演算法延遲合併。
+    若要讓 4MB 緩衝區生效，主機需調高上限，例如：
+        sysctl -w net.core.wmem_max=16777216
+        sysctl -w net.core.rmem_max=16777216
+    """
+    if sock.family not in (socket.AF_INET, socket.AF_INET6):
+        return # gunicorn 也可能綁定 Unix socket，沒有這些 TCP 選項
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+
+
+def _listen_socket(host: str, port: int) -> socket.socket:
+    """建立已設定好 TCP 選項的監聽 socket。"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    _tune_socket(sock)
+    sock.bind((host, port))
+    return sock
+
+
+try:
+    from uvicorn_worker import UvicornWorker
+except ImportError: # 未安裝 uvicorn-worker（例如 Windows 上直接執行）時不提供 gunicorn worker
+    UvicornWorker = None
+
+if UvicornWorker is not None:
+    class Worker(UvicornWorker):
+        """gunicorn worker：套用與直接執行相同的 uvicorn 設定與 TCP 選項。"""
+        CONFIG_KWARGS = UVICORN_CONFIG
+
+        def init_process(self):
+            # 監聽 socket 由 gunicorn 建立，於 worker 啟動時補上 TCP 選項
+            for sock in self.sockets:
+                _tune_socket(sock)
+            super().init_process()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    config = uvicorn.Config(app, **UVICORN_CONFIG)
+    uvicorn.Server(config).run(sockets=[_listen_socket("0.0.0.0", int(os.environ.get("PORT", "8000")))])